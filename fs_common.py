@@ -0,0 +1,546 @@
+"""
+FS Source - helpers shared by fs_source.py, fs_source_daemon.py and fs_source_native.py
+Raw TFLite BlazeFace, face tracking, camera/OBS frame capture and the OBS scene item cache
+"""
+
+import json
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+import queue
+import threading
+from obswebsocket import events as obs_events, requests as obs_requests
+
+logger = logging.getLogger(__name__)
+
+# pybase64 is a drop-in, SIMD-accelerated base64 decoder for the screenshot payload
+try:
+    import pybase64 as base64
+except ImportError:
+    import base64
+
+# cv2, mediapipe and numpy take seconds and a few hundred MB to import, which the
+# daemon should not pay while idling in standby; load_vision_modules() brings
+# them in the first time something here needs them
+cv2 = mp = np = BaseOptions = vision = TFLiteInterpreter = None
+
+def load_vision_modules():
+    """Import the detection stack into module globals (first call only)"""
+    global cv2, mp, np, BaseOptions, vision, TFLiteInterpreter
+    if np is not None:
+        return
+    import cv2
+    import mediapipe as mp
+    from mediapipe.tasks.python import BaseOptions, vision
+    # Optional raw TFLite interpreter, used for BlazeFace models (tflite_model_path)
+    try:
+        from ai_edge_litert.interpreter import Interpreter as TFLiteInterpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter as TFLiteInterpreter
+        except ImportError:
+            TFLiteInterpreter = None
+    import numpy as np
+
+def create_face_detector(config, min_detection_confidence):
+    """Create the MediaPipe Tasks face detector, on the GPU when possible"""
+    load_vision_modules()
+    # Defaults to the short-range BlazeFace model bundled with mediapipe
+    model_path = config.get('face_model_path') or str(
+        Path(mp.__file__).parent / 'modules' / 'face_detection' / 'face_detection_short_range.tflite'
+    )
+    
+    def create(delegate):
+        options = vision.FaceDetectorOptions(
+            base_options=BaseOptions(model_asset_path=model_path, delegate=delegate),
+            min_detection_confidence=min_detection_confidence
+        )
+        return vision.FaceDetector.create_from_options(options)
+    
+    if config.get('use_gpu', True):
+        try:
+            detector = create(BaseOptions.Delegate.GPU)
+            logger.info("Face detection running on GPU")
+            return detector
+        except Exception as e:
+            logger.info("GPU delegate unavailable, face detection running on CPU")
+            logger.debug(f"GPU delegate error: {e}")
+    
+    return create(BaseOptions.Delegate.CPU)
+
+# FaceDetection graphs take 100ms-1s to build, so they are shared per settings
+_FACE_DETECTORS = {}
+
+def get_face_detector(min_detection_confidence, model_selection=0):
+    """Return a shared MediaPipe FaceDetection for these settings"""
+    key = (model_selection, min_detection_confidence)
+    if key not in _FACE_DETECTORS:
+        load_vision_modules()
+        _FACE_DETECTORS[key] = mp.solutions.face_detection.FaceDetection(
+            model_selection=model_selection,
+            min_detection_confidence=min_detection_confidence
+        )
+    return _FACE_DETECTORS[key]
+
+def blazeface_anchors():
+    """SSD anchor centres for the 128x128 short-range BlazeFace model (896 anchors)"""
+    anchors = []
+    # Stride 8 has 2 anchors per cell, the three stride 16 layers add up to 6
+    for stride, per_cell in ((8, 2), (16, 6)):
+        grid = 128 // stride
+        for y in range(grid):
+            for x in range(grid):
+                anchors.extend([((x + 0.5) / grid, (y + 0.5) / grid)] * per_cell)
+    return np.array(anchors, dtype=np.float32)
+
+def detector_threads():
+    """Thread count for the raw TFLite interpreter (MediaPipe's own graph takes none)
+    
+    Half the cores unless TF_NUM_INTRAOP_THREADS says otherwise. XNNPACK picks
+    AVX2/AVX512F/AVX512_VNNI/FMA kernels on its own when the build supports them.
+    """
+    default = max(1, (os.cpu_count() or 2) // 2)
+    value = os.environ.get('TF_NUM_INTRAOP_THREADS', '').strip()
+    if not value:
+        return default
+    try:
+        return max(1, int(value))
+    except ValueError:
+        logger.warning(f"Ignoring TF_NUM_INTRAOP_THREADS={value!r}, using {default} thread(s)")
+        return default
+
+class BlazeFaceTFLite:
+    """BlazeFace run straight through the TFLite interpreter, skipping the MediaPipe graph
+    
+    Works with float and quantized INT8 models. Images are RGB, or BGR with bgr=True.
+    """
+    
+    def __init__(self, model_path, bgr=False):
+        load_vision_modules()
+        self.interpreter = TFLiteInterpreter(model_path=model_path, num_threads=detector_threads())
+        self.interpreter.allocate_tensors()
+        self._bgr = bgr
+        self._input = self.interpreter.get_input_details()[0]
+        self._outputs = {d['name']: d for d in self.interpreter.get_output_details()}
+        self._canvas = np.zeros((128, 128, 3), np.uint8)
+        self._tensor = np.empty((1, 128, 128, 3), np.float32)
+        self._anchors = blazeface_anchors()
+    
+    def _invoke(self, image):
+        """Run the model on an image; returns the letterbox (scale, pad_x, pad_y)"""
+        # Letterbox into the 128x128 input, like MediaPipe's own preprocessing
+        img_h, img_w = image.shape[:2]
+        scale = 128 / max(img_h, img_w)
+        new_w, new_h = round(img_w * scale), round(img_h * scale)
+        pad_x, pad_y = (128 - new_w) // 2, (128 - new_h) // 2
+        self._canvas[pad_y:pad_y + new_h, pad_x:pad_x + new_w] = cv2.resize(
+            image, (new_w, new_h), interpolation=cv2.INTER_AREA
+        )
+        if self._bgr:
+            cv2.cvtColor(self._canvas, cv2.COLOR_BGR2RGB, dst=self._canvas)
+        
+        # Model expects [-1, 1]; quantized inputs are mapped onto their integer range
+        tensor = self._tensor
+        np.multiply(self._canvas, 1 / 127.5, out=tensor[0])
+        tensor -= 1.0
+        in_scale, in_zero_point = self._input['quantization']
+        if in_scale:
+            tensor = np.round(tensor / in_scale + in_zero_point)
+        self.interpreter.set_tensor(self._input['index'], tensor.astype(self._input['dtype']))
+        self.interpreter.invoke()
+        return scale, pad_x, pad_y
+    
+    def _output(self, name):
+        """Read an output tensor, dequantizing INT8 models"""
+        details = self._outputs[name]
+        tensor = self.interpreter.get_tensor(details['index'])
+        scale, zero_point = details['quantization']
+        if scale:
+            return (tensor.astype(np.float32) - zero_point) * scale
+        return tensor
+    
+    def best_score(self, image):
+        """Best face score in the image, without decoding any box"""
+        self._invoke(image)
+        
+        # Filter first: a yes/no answer only needs the best anchor's logit, so no
+        # boxes are decoded, no NMS runs and the sigmoid sees a single value
+        details = self._outputs['classificators']
+        best = float(self.interpreter.get_tensor(details['index']).max())
+        out_scale, out_zero_point = details['quantization']
+        if out_scale:
+            best = (best - out_zero_point) * out_scale
+        return float(1 / (1 + np.exp(-np.clip(best, -100, 100))))
+    
+    def detect(self, image):
+        """Best face in the image
+        
+        Returns (score, (x, y, w, h)) of the best face, box in image pixels
+        """
+        scale, pad_x, pad_y = self._invoke(image)
+        
+        # Only the best anchor matters, so decode just that one box
+        raw_scores = self._output('classificators')[0, :, 0]
+        best = int(np.argmax(raw_scores))
+        score = float(1 / (1 + np.exp(-np.clip(raw_scores[best], -100, 100))))
+        
+        box = self._output('regressors')[0, best]
+        cx = box[0] / 128 + self._anchors[best, 0]
+        cy = box[1] / 128 + self._anchors[best, 1]
+        w, h = box[2] / 128, box[3] / 128
+        x = ((cx - w / 2) * 128 - pad_x) / scale
+        y = ((cy - h / 2) * 128 - pad_y) / scale
+        return score, (int(x), int(y), int(w * 128 / scale), int(h * 128 / scale))
+
+def create_tflite_detector(config, bgr=False):
+    """Load tflite_model_path into a BlazeFaceTFLite, or None if unset or unavailable"""
+    model_path = config.get('tflite_model_path')
+    if not model_path:
+        return None
+    load_vision_modules()
+    if TFLiteInterpreter is None:
+        logger.warning("tflite_model_path set but no TFLite runtime installed "
+                       "(pip install ai-edge-litert), using MediaPipe instead")
+        return None
+    
+    detector = BlazeFaceTFLite(model_path, bgr)
+    logger.info(f"Face detection running on raw TFLite model: {model_path}")
+    return detector
+
+class FaceTracker:
+    """Follow the last detected face with a template match instead of re-detecting it"""
+    
+    def __init__(self, config):
+        load_vision_modules()
+        # A full detection is still due at least every face_track_frames frames
+        self.max_frames = config.get('face_track_frames', 10)
+        self.threshold = config.get('face_track_threshold', 0.7)
+        # Last face crop/box and how many frames it has been tracked for
+        self._crop = None
+        self._bbox = None
+        self._tracked_frames = 0
+    
+    def remember(self, image, face_box):
+        """Keep a crop of the detected face (None when there was none)"""
+        self._crop = None
+        self._tracked_frames = 0
+        if face_box is None:
+            return
+        
+        x, y, w, h = face_box
+        img_h, img_w = image.shape[:2]
+        x, y = max(0, x), max(0, y)
+        w, h = min(w, img_w - x), min(h, img_h - y)
+        if w >= 8 and h >= 8:
+            self._crop = image[y:y + h, x:x + w].copy()
+            self._bbox = (x, y, w, h)
+    
+    def track(self, image):
+        """Check the last face is still there with a template match around its position
+        
+        False when there is no face to follow or a full detection is due.
+        """
+        if self._crop is None or self._tracked_frames >= self.max_frames:
+            return False
+        
+        x, y, w, h = self._bbox
+        img_h, img_w = image.shape[:2]
+        
+        # Search half a face beyond the last bounding box on every side
+        x0, y0 = max(0, x - w // 2), max(0, y - h // 2)
+        x1, y1 = min(img_w, x + w + w // 2), min(img_h, y + h + h // 2)
+        roi = image[y0:y1, x0:x1]
+        if roi.shape[0] < h or roi.shape[1] < w:
+            return False
+        
+        scores = cv2.matchTemplate(roi, self._crop, cv2.TM_CCOEFF_NORMED)
+        _, max_score, _, max_loc = cv2.minMaxLoc(scores)
+        if max_score < self.threshold:
+            return False
+        
+        # Follow the face, but keep matching against the detector's crop
+        self._bbox = (x0 + max_loc[0], y0 + max_loc[1], w, h)
+        self._tracked_frames += 1
+        return True
+
+class OBSFrameSource:
+    """RGB frames of an OBS source, from WebSocket screenshots or the OBS virtual camera"""
+    
+    def __init__(self, config, obs_ws, obs_lock):
+        load_vision_modules()
+        self.config = config
+        self.obs_ws = obs_ws
+        # Screenshots share the connection with the toggles
+        self.obs_lock = obs_lock
+        # OBS Virtual Camera / v4l2loopback capture, used instead of screenshots when local
+        self._local_capture = None
+    
+    def get_frame(self, source_name):
+        """Get a frame of the OBS source as an RGB array"""
+        try:
+            if self._local_capture is not None:
+                ret, frame = self._local_capture.read()
+                if ret:
+                    # Same working size as the screenshots below; the static-frame
+                    # gate and face tracker are tuned for it
+                    frame = cv2.resize(frame, (256, 192), interpolation=cv2.INTER_AREA)
+                    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                logger.warning("Local capture read failed, falling back to OBS screenshots")
+                self.close_local_capture()
+            
+            # Get source screenshot (BlazeFace runs at 128x128, so a small
+            # 4:3 frame is plenty and keeps encode/transfer/decode cheap)
+            with self.obs_lock:
+                response = self.obs_ws.call(obs_requests.GetSourceScreenshot(
+                    sourceName=source_name,
+                    imageFormat='jpg',
+                    imageWidth=256,
+                    imageHeight=192,
+                    imageCompressionQuality=85
+                ))
+            
+            # Decode base64 image (strip the data URL prefix)
+            img_data = response.getImageData()
+            if img_data.startswith('data:'):
+                img_data = img_data.partition(',')[2]
+            
+            img_bytes = base64.b64decode(img_data)
+            
+            # Decode straight to RGB (what MediaPipe wants), no PIL hop needed
+            frame = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR_RGB)
+            if frame is None:
+                raise ValueError("Could not decode screenshot data")
+            return frame
+        
+        except Exception as e:
+            logger.error(f"Failed to get source screenshot: {e}")
+            return None
+    
+    def open_local_capture(self):
+        """Read frames from the OBS virtual camera when OBS runs on this machine"""
+        device = self.config.get('v4l2_device')
+        if device is None or self.config.get('obs_host') not in ('localhost', '127.0.0.1'):
+            return False
+        
+        # Windows: OBS Virtual Camera index via DirectShow; Linux: v4l2loopback device
+        if sys.platform == 'win32':
+            if not str(device).strip().isdigit():
+                logger.warning(f"v4l2_device must be a camera index on Windows, got {device!r}; using OBS screenshots")
+                return False
+            capture = cv2.VideoCapture(int(device), cv2.CAP_DSHOW)
+        elif isinstance(device, int):
+            capture = cv2.VideoCapture(device)
+        else:
+            capture = cv2.VideoCapture(str(device), cv2.CAP_V4L2)
+        
+        if not capture.isOpened():
+            logger.warning(f"Could not open local capture device {device}, using OBS screenshots")
+            capture.release()
+            return False
+        
+        # Only the newest frame matters
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        self._local_capture = capture
+        logger.info(f"Reading frames from local capture device {device}")
+        return True
+    
+    def close_local_capture(self):
+        """Release the local capture device, if open"""
+        if self._local_capture is not None:
+            self._local_capture.release()
+            self._local_capture = None
+    
+    def worker(self, source_name, frame_slot, stop_event):
+        """Fetch frames on a background thread so OBS round-trips overlap inference"""
+        check_interval = self.config.get('check_interval', 0.5)
+        next_shot = time.monotonic()
+        
+        while not stop_event.is_set():
+            frame = self.get_frame(source_name)
+            
+            # Latest frame wins - drop one detection has not picked up yet
+            try:
+                frame_slot.get_nowait()
+            except queue.Empty:
+                pass
+            frame_slot.put_nowait(frame)
+            
+            # Fixed cadence: the round-trip comes out of the interval instead of
+            # adding to it; if we fell behind, start over rather than burst
+            next_shot += check_interval
+            now = time.monotonic()
+            if next_shot < now:
+                next_shot = now
+            stop_event.wait(next_shot - now)
+
+class FrameGrabber:
+    """Read a camera on a background thread, keeping only the newest frame"""
+    
+    def __init__(self, camera):
+        self.camera = camera
+        self.latest = None
+        self.failed = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        while not self._stop.is_set():
+            ret, frame = self.camera.read()
+            if not ret:
+                self.failed = True
+                break
+            with self._lock:
+                self.latest = frame
+    
+    def get(self):
+        """Return the newest frame, or None if none arrived since the last call"""
+        with self._lock:
+            frame, self.latest = self.latest, None
+        return frame
+    
+    def stop(self):
+        """Stop the capture thread (call before releasing the camera)"""
+        self._stop.set()
+        self._thread.join(timeout=2)
+
+class PreviewBuffer:
+    """Convert RGB frames to a BGR UMat for display, reusing one buffer
+    
+    Colour conversion, text overlay and imshow all accept a UMat, which
+    OpenCV runs through OpenCL when a GPU is available and on the CPU otherwise.
+    """
+    
+    def __init__(self):
+        load_vision_modules()
+        self._buf = None
+        self._shape = None
+    
+    def convert(self, frame):
+        if self._buf is None or self._shape != frame.shape:
+            self._buf = cv2.UMat(frame.shape[0], frame.shape[1], cv2.CV_8UC3)
+            self._shape = frame.shape
+        return cv2.cvtColor(cv2.UMat(frame), cv2.COLOR_RGB2BGR, dst=self._buf)
+
+# OBS events that change which scene items exist (invalidate the scene cache)
+SCENE_CACHE_EVENTS = (
+    obs_events.SceneCreated,
+    obs_events.SceneRemoved,
+    obs_events.SceneNameChanged,
+    obs_events.SceneItemCreated,
+    obs_events.SceneItemRemoved,
+    obs_events.SceneItemListReindexed,
+    obs_events.InputNameChanged,
+    # A collection switch replaces every scene without per-scene/item events
+    obs_events.CurrentSceneCollectionChanged,
+)
+
+class SceneItemCache:
+    """The scene items showing each source, across all scenes
+    
+    Dropped whenever OBS reports a layout change and rebuilt on the next lookup,
+    so toggles normally need no GetSceneList/GetSceneItemList round-trips.
+    """
+    
+    def __init__(self, obs_ws):
+        self.obs_ws = obs_ws
+        # {source_name: [(scene_name, scene_item_id), ...]}, None when stale
+        self._items = None
+        for event in SCENE_CACHE_EVENTS:
+            obs_ws.register(self.invalidate, event)
+    
+    def build(self):
+        """Map every source to the scene items that show it, across all scenes"""
+        items = {}
+        
+        scenes_response = self.obs_ws.call(obs_requests.GetSceneList())
+        for scene in scenes_response.getScenes():
+            scene_name = scene['sceneName']
+            try:
+                scene_items = self.obs_ws.call(obs_requests.GetSceneItemList(sceneName=scene_name))
+                for item in scene_items.getSceneItems():
+                    items.setdefault(item['sourceName'], []).append((scene_name, item['sceneItemId']))
+            except Exception as e:
+                logger.debug(f"Could not list items in scene '{scene_name}': {e}")
+        
+        self._items = items
+        logger.debug(f"Scene cache built: {len(items)} source(s)")
+        return items
+    
+    def invalidate(self, event=None):
+        """OBS scene layout changed - rebuild the cache on the next lookup"""
+        # Runs on the obsws receive thread, so it must not call back into OBS
+        self._items = None
+    
+    def get(self, source_name):
+        """[(scene_name, scene_item_id), ...] showing source_name, rebuilding when stale"""
+        items = self._items
+        if items is None:
+            items = self.build()
+        return items.get(source_name, [])
+    
+    def set_enabled(self, source_name, enabled, exclude_scenes=()):
+        """Show or hide source_name in every scene except exclude_scenes
+        
+        Every answer is checked; if OBS rejects an item (usually a scene item
+        the cache missed a change to), the cache is rebuilt and the toggle sent
+        once more. Returns the number of scenes OBS confirmed.
+        """
+        for attempt in range(2):
+            batch = []
+            for scene_name, scene_item_id in self.get(source_name):
+                if scene_name in exclude_scenes:
+                    logger.debug(f"Skipping excluded scene: {scene_name}")
+                    continue
+                batch.append(obs_requests.SetSceneItemEnabled(
+                    sceneName=scene_name,
+                    sceneItemId=scene_item_id,
+                    sceneItemEnabled=enabled
+                ))
+            
+            failed = [request for request in call_batch(self.obs_ws, batch) if not request.status]
+            if not failed or attempt:
+                break
+            logger.debug(f"{len(failed)} scene item(s) of {source_name} rejected, rebuilding scene cache")
+            self.invalidate()
+        
+        for request in failed:
+            logger.warning(f"Could not set {source_name} in '{request.data()['sceneName']}': "
+                           f"{request.datain.get('comment', request.datain.get('code'))}")
+        return len(batch) - len(failed)
+
+def call_batch(obs_ws, batch):
+    """Send several requests back to back, then collect all the answers
+    
+    obs-websocket-py cannot read RequestBatch responses, so the requests are
+    pipelined instead: the whole list costs one round-trip rather than one each.
+    Returns the request objects populated with their responses, like obs_ws.call().
+    """
+    pending = []
+    for request in batch:
+        message_id = str(obs_ws.id)
+        obs_ws.id += 1
+        obs_ws.events[message_id] = threading.Event()
+        obs_ws.ws.send(json.dumps({
+            "op": 6,
+            "d": {
+                "requestId": message_id,
+                "requestType": request.name,
+                "requestData": request.data()
+            }
+        }))
+        pending.append((request, message_id))
+    
+    for request, message_id in pending:
+        obs_ws.events[message_id].wait(obs_ws.timeout)
+        obs_ws.events.pop(message_id)
+        answer = obs_ws.answers.pop(message_id, None)
+        if answer is None:
+            raise TimeoutError(f"No answer for {request.name}")
+        # Failed requests carry no responseData; keep their status (code, comment)
+        request.input(answer.get('responseData', answer['requestStatus']), answer['requestStatus']['result'])
+    
+    return [request for request, _ in pending]
@@ -9,13 +9,16 @@ import time
 import cv2
 import mediapipe as mp
 import numpy as np
-from obswebsocket import obsws, requests as obs_requests
+from obswebsocket import obsws
 import logging
+import queue
 import sys
+import threading
 from pathlib import Path
-import base64
-from io import BytesIO
-from PIL import Image
+from fs_common import (
+    FaceTracker, OBSFrameSource, PreviewBuffer, SceneItemCache,
+    create_face_detector, create_tflite_detector
+)
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -25,14 +28,29 @@ class FaceDetectionSwitcher:
     def __init__(self, config):
         self.config = config
         self.obs_ws = None
-        self.mp_face_detection = mp.solutions.face_detection
-        self.mp_drawing = mp.solutions.drawing_utils
-        self.face_detection = self.mp_face_detection.FaceDetection(
-            model_selection=0, 
-            min_detection_confidence=config.get('face_detection_confidence', 0.7)
-        )
+        self._conf_threshold = config.get('face_detection_confidence', 0.7)
+        self.tflite = create_tflite_detector(config)
+        self.face_detector = None if self.tflite else create_face_detector(config, self._conf_threshold)
         self.face_detected = False
         self.last_detection_time = 0
+        # Thumbnail and result of the last frame MediaPipe actually processed
+        self._last_small = None
+        self._last_result = False
+        # Largest per-cell change (0-255) still treated as the same frame; a face
+        # leaving changes its cells by far more, so the mean would hide it
+        self._static_frame_threshold = config.get('static_frame_threshold', 12)
+        # A cached "face present" is reused at most this many frames in a row
+        self._static_frame_max_reuse = config.get('static_frame_max_reuse', 10)
+        self._static_reuse_count = 0
+        # Template tracking of the last face, used to skip MediaPipe while it stays put
+        self.tracker = FaceTracker(config)
+        # Created once connected to OBS
+        self.scene_items = None
+        self.frames = None
+        # Screenshot thread and toggles share one OBS connection
+        self._obs_lock = threading.Lock()
+        # Reused BGR buffer (UMat) for the preview window
+        self._preview = PreviewBuffer()
         
     def connect_obs(self):
         """Connect to OBS WebSocket"""
@@ -44,6 +62,10 @@ class FaceDetectionSwitcher:
             )
             self.obs_ws.connect()
             logger.info(f"Connected to OBS at {self.config['obs_host']}:{self.config['obs_port']}")
+            
+            self.scene_items = SceneItemCache(self.obs_ws)
+            self.scene_items.build()
+            self.frames = OBSFrameSource(self.config, self.obs_ws, self._obs_lock)
             return True
         except Exception as e:
             logger.error(f"Failed to connect to OBS: {e}")
@@ -55,44 +77,40 @@ class FaceDetectionSwitcher:
             self.obs_ws.disconnect()
             logger.info("Disconnected from OBS")
     
-    def get_source_screenshot(self, source_name):
-        """Get screenshot from OBS source"""
-        try:
-            # Get source screenshot
-            response = self.obs_ws.call(obs_requests.GetSourceScreenshot(
-                sourceName=source_name,
-                imageFormat='png',
-                imageWidth=640,
-                imageHeight=480
-            ))
-            
-            # Decode base64 image
-            img_data = response.getImageData()
-            if img_data.startswith('data:image/png;base64,'):
-                img_data = img_data.split(',')[1]
-            
-            img_bytes = base64.b64decode(img_data)
-            img = Image.open(BytesIO(img_bytes))
-            
-            # Convert to OpenCV format (BGR)
-            frame = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-            return frame
-            
-        except Exception as e:
-            logger.error(f"Failed to get source screenshot: {e}")
-            return None
-    
     def detect_face(self, image):
-        """Detect faces in the image using MediaPipe"""
-        rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        results = self.face_detection.process(rgb_image)
+        """Detect faces in an RGB image using MediaPipe"""
+        # Reuse the last result if no thumbnail cell changed noticeably; a cached
+        # face is only trusted for so long, in case it left without much change
+        small = cv2.resize(image, (32, 24), interpolation=cv2.INTER_AREA).astype(np.int16)
+        if self._last_small is not None and \
+                np.abs(small - self._last_small).max() < self._static_frame_threshold and \
+                not (self._last_result and self._static_reuse_count >= self._static_frame_max_reuse):
+            self._static_reuse_count += 1
+            return self._last_result
+        
+        # While a face is present a template match stands in for MediaPipe,
+        # with a full detection at least every face_track_frames frames
+        if self.face_detected and self.tracker.track(image):
+            return True
+        
+        face_box = None
+        if self.tflite:
+            score, box = self.tflite.detect(image)
+            if score > self._conf_threshold:
+                face_box = box
+        else:
+            results = self.face_detector.detect(mp.Image(image_format=mp.ImageFormat.SRGB, data=image))
+            # The detector already drops anything under min_detection_confidence
+            if results.detections:
+                box = results.detections[0].bounding_box
+                face_box = (box.origin_x, box.origin_y, box.width, box.height)
         
-        if results.detections:
-            for detection in results.detections:
-                # Check if face is facing forward (confidence-based)
-                if detection.score[0] > self.config.get('face_detection_confidence', 0.7):
-                    return True
-        return False
+        self.tracker.remember(image, face_box)
+        face_found = face_box is not None
+        self._last_small = small
+        self._last_result = face_found
+        self._static_reuse_count = 0
+        return face_found
     
     def set_source_visibility_global(self, source_name, visible, exclude_scenes=None):
         """Set OBS source visibility across all scenes (with optional exclusions)"""
@@ -101,46 +119,21 @@ class FaceDetectionSwitcher:
         
         if exclude_scenes is None:
             exclude_scenes = []
+        # Set for O(1) membership tests against every cached scene item
+        excluded = set(exclude_scenes)
         
         try:
             if not source_name:
                 logger.warning("Source name not configured")
                 return False
             
-            # Get list of all scenes
-            scenes_response = self.obs_ws.call(obs_requests.GetSceneList())
-            all_scenes = scenes_response.getScenes()
-            
-            scenes_modified = 0
-            
-            for scene in all_scenes:
-                scene_name = scene['sceneName']
-                
-                # Skip excluded scenes
-                if scene_name in exclude_scenes:
-                    logger.debug(f"Skipping excluded scene: {scene_name}")
-                    continue
-                
-                # Get scene items
-                try:
-                    scene_items = self.obs_ws.call(obs_requests.GetSceneItemList(sceneName=scene_name))
-                    
-                    for item in scene_items.getSceneItems():
-                        if item['sourceName'] == source_name:
-                            self.obs_ws.call(obs_requests.SetSceneItemEnabled(
-                                sceneName=scene_name,
-                                sceneItemId=item['sceneItemId'],
-                                sceneItemEnabled=visible
-                            ))
-                            logger.debug(f"Set {source_name} to {visible} in '{scene_name}'")
-                            scenes_modified += 1
-                except Exception as e:
-                    logger.debug(f"Could not modify {source_name} in scene '{scene_name}': {e}")
-                    continue
+            # Scene items come from the cache, and OBS confirms every toggle
+            with self._obs_lock:
+                scenes_modified = self.scene_items.set_enabled(source_name, visible, excluded)
             
             if scenes_modified > 0:
                 excluded_note = f" (excluded: {', '.join(exclude_scenes)})" if exclude_scenes else ""
-                logger.info(f"Set {source_name} visibility to {visible} in {scenes_modified} scene(s){excluded_note}")
+                logger.info(f"Set {source_name} visibility {visible} in {scenes_modified} scene(s){excluded_note}")
                 return True
             else:
                 logger.warning(f"Source '{source_name}' not found in any scenes")
@@ -164,6 +157,7 @@ class FaceDetectionSwitcher:
         detection_scene = self.config.get('detection_scene_name')
         show_source = self.config.get('show_source_name')
         hide_source = self.config.get('hide_source_name')
+        show_preview = self.config.get('show_preview', False)
         
         if not monitor_source:
             logger.error("monitor_source_name not configured")
@@ -183,16 +177,28 @@ class FaceDetectionSwitcher:
             if exclude_scenes:
                 logger.info(f"  • Exception: Keep {show_source} visible in: {', '.join(exclude_scenes)}")
         
+        # Screenshots arrive from a background thread through a one-frame slot
+        frame_slot = queue.Queue(maxsize=1)
+        stop_event = threading.Event()
+        screenshot_thread = threading.Thread(
+            target=self.frames.worker,
+            args=(monitor_source, frame_slot, stop_event),
+            daemon=True
+        )
+        
         try:
+            # Local capture is released in the finally block if anything here fails
+            self.frames.open_local_capture()
+            screenshot_thread.start()
+            
             logger.info("Face detection active. Press Ctrl+C to quit.")
             
             while True:
-                # Get screenshot from OBS source
-                frame = self.get_source_screenshot(monitor_source)
+                # Wait for the newest screenshot from the OBS source
+                frame = frame_slot.get()
                 
                 if frame is None:
                     logger.warning("Failed to get frame from source, retrying...")
-                    time.sleep(self.config.get('check_interval', 0.5))
                     continue
                 
                 # Detect face
@@ -216,7 +222,9 @@ class FaceDetectionSwitcher:
                             self.set_source_visibility_global(show_source, False, exclude_scenes)
                 
                 # Optional: Show preview window (for debugging)
-                if self.config.get('show_preview', False):
+                if show_preview:
+                    # Frames are RGB, convert once for display only (as a UMat)
+                    frame = self._preview.convert(frame)
                     # Draw detection status on frame
                     status = "FACE DETECTED" if self.face_detected else "NO FACE"
                     color = (0, 255, 0) if self.face_detected else (0, 0, 255)
@@ -226,9 +234,6 @@ class FaceDetectionSwitcher:
                     if cv2.waitKey(1) & 0xFF == ord('q'):
                         break
                 
-                # Sleep to control check interval
-                time.sleep(self.config.get('check_interval', 0.5))
-                
         except KeyboardInterrupt:
             logger.info("Shutting down...")
         except Exception as e:
@@ -236,6 +241,10 @@ class FaceDetectionSwitcher:
             import traceback
             traceback.print_exc()
         finally:
+            stop_event.set()
+            if screenshot_thread.is_alive():
+                screenshot_thread.join(timeout=2)
+            self.frames.close_local_capture()
             cv2.destroyAllWindows()
             self.disconnect_obs()
 
@@ -7,17 +7,17 @@ Activates when OBS is running and connected
 
 import json
 import time
-import cv2
-import mediapipe as mp
-import numpy as np
-from obswebsocket import obsws, requests as obs_requests
+from obswebsocket import obsws, events as obs_events
 import logging
+import queue
 import sys
+import threading
 from pathlib import Path
-import base64
-from io import BytesIO
-from PIL import Image
-from datetime import datetime
+import fs_common
+from fs_common import (
+    FaceTracker, OBSFrameSource, PreviewBuffer, SceneItemCache,
+    create_face_detector, create_tflite_detector
+)
 
 # Setup logging
 logging.basicConfig(
@@ -30,33 +30,76 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# cv2, mediapipe and numpy take seconds and a few hundred MB to import, which the
+# daemon should not pay while idling in standby; load_vision_modules() brings
+# them in on the first switch to active mode
+cv2 = mp = np = None
+
+def load_vision_modules():
+    """Import the detection stack into module globals (first call only)"""
+    global cv2, mp, np
+    fs_common.load_vision_modules()
+    cv2, mp, np = fs_common.cv2, fs_common.mp, fs_common.np
+
 class FaceDetectionDaemon:
     def __init__(self, config):
         self.config = config
         self.obs_ws = None
-        self.mp_face_detection = mp.solutions.face_detection
-        self.mp_drawing = mp.solutions.drawing_utils
-        self.face_detection = self.mp_face_detection.FaceDetection(
-            model_selection=0, 
-            min_detection_confidence=config.get('face_detection_confidence', 0.7)
-        )
+        self._conf_threshold = config.get('face_detection_confidence', 0.7)
+        # Created by _init_detector() on the first switch to active mode
+        self.tflite = None
+        self.face_detector = None
+        self.tracker = None
+        self._preview = None
         self.face_detected = False
         self.last_detection_time = 0
+        # Thumbnail and result of the last frame MediaPipe actually processed
+        self._last_small = None
+        self._last_result = False
+        # Largest per-cell change (0-255) still treated as the same frame; a face
+        # leaving changes its cells by far more, so the mean would hide it
+        self._static_frame_threshold = config.get('static_frame_threshold', 12)
+        # A cached "face present" is reused at most this many frames in a row
+        self._static_frame_max_reuse = config.get('static_frame_max_reuse', 10)
+        self._static_reuse_count = 0
         self.is_active = False
         self.reconnect_attempts = 0
         self.max_reconnect_attempts = 10
+        # Set/cleared by OBS WebSocket callbacks, so checking state needs no RPC
+        self._obs_connected = threading.Event()
+        # Created once connected to OBS
+        self.scene_items = None
+        # Screenshot thread and toggles share one OBS connection
+        self._obs_lock = threading.Lock()
         
+    def _init_detector(self):
+        """Load the vision stack and create the face detector, once"""
+        if self.tflite or self.face_detector:
+            return
+        load_vision_modules()
+        self.tflite = create_tflite_detector(self.config)
+        self.face_detector = None if self.tflite else create_face_detector(self.config, self._conf_threshold)
+        # Template tracking of the last face, used to skip MediaPipe while it stays put
+        self.tracker = FaceTracker(self.config)
+        # Reused BGR buffer (UMat) for the preview window
+        self._preview = PreviewBuffer()
+    
     def connect_obs(self):
         """Connect to OBS WebSocket with retry logic"""
         try:
             self.obs_ws = obsws(
                 self.config['obs_host'], 
                 self.config['obs_port'], 
-                self.config.get('obs_password', '')
+                self.config.get('obs_password', ''),
+                on_connect=self._on_obs_connect,
+                on_disconnect=self._on_obs_disconnect
             )
             self.obs_ws.connect()
+            self.obs_ws.register(self._on_obs_exit, obs_events.ExitStarted)
             logger.info(f"Connected to OBS at {self.config['obs_host']}:{self.config['obs_port']}")
             self.reconnect_attempts = 0
+            self.scene_items = SceneItemCache(self.obs_ws)
+            self.scene_items.build()
             return True
         except Exception as e:
             self.reconnect_attempts += 1
@@ -77,6 +120,7 @@ class FaceDetectionDaemon:
     
     def disconnect_obs(self):
         """Disconnect from OBS WebSocket"""
+        self._obs_connected.clear()
         if self.obs_ws:
             try:
                 self.obs_ws.disconnect()
@@ -85,61 +129,70 @@ class FaceDetectionDaemon:
                 pass
             self.obs_ws = None
     
+    def _on_obs_connect(self, obs):
+        """Called by obsws once the WebSocket handshake completes"""
+        self._obs_connected.set()
+        # Layout events sent while disconnected were missed
+        if self.scene_items:
+            self.scene_items.invalidate()
+    
+    def _on_obs_disconnect(self, obs):
+        """Called by obsws when the connection is closed or lost"""
+        self._obs_connected.clear()
+    
+    def _on_obs_exit(self, event):
+        """OBS announces its shutdown before closing the socket"""
+        logger.debug("OBS is shutting down")
+        self._obs_connected.clear()
+    
     def is_obs_active(self):
         """Check if OBS is running and connected"""
         if not self.obs_ws:
             return False
         
-        try:
-            # Just check if we can get version info (confirms OBS is responsive)
-            version = self.obs_ws.call(obs_requests.GetVersion())
+        if self._obs_connected.is_set():
             return True
-            
-        except Exception as e:
-            # Connection is broken, disconnect and let standby mode reconnect
-            logger.debug(f"OBS not responsive: {e}")
-            self.disconnect_obs()
-            return False
+        
+        # Connection is gone, drop the stale client and let standby mode reconnect
+        logger.debug("OBS connection lost")
+        self.disconnect_obs()
+        return False
     
-    def get_source_screenshot(self, source_name):
-        """Get screenshot from OBS source"""
+    def detect_face(self, image):
+        """Detect faces in an RGB image using MediaPipe"""
         try:
-            # Get source screenshot
-            response = self.obs_ws.call(obs_requests.GetSourceScreenshot(
-                sourceName=source_name,
-                imageFormat='png',
-                imageWidth=640,
-                imageHeight=480
-            ))
+            # Reuse the last result if no thumbnail cell changed noticeably; a cached
+            # face is only trusted for so long, in case it left without much change
+            small = cv2.resize(image, (32, 24), interpolation=cv2.INTER_AREA).astype(np.int16)
+            if self._last_small is not None and \
+                    np.abs(small - self._last_small).max() < self._static_frame_threshold and \
+                    not (self._last_result and self._static_reuse_count >= self._static_frame_max_reuse):
+                self._static_reuse_count += 1
+                return self._last_result
             
-            # Decode base64 image
-            img_data = response.getImageData()
-            if img_data.startswith('data:image/png;base64,'):
-                img_data = img_data.split(',')[1]
-            
-            img_bytes = base64.b64decode(img_data)
-            img = Image.open(BytesIO(img_bytes))
-            
-            # Convert to OpenCV format (BGR)
-            frame = cv2.cvtColor(np.array(img), cv2.COLOR_RGB2BGR)
-            return frame
+            # While a face is present a template match stands in for MediaPipe,
+            # with a full detection at least every face_track_frames frames
+            if self.face_detected and self.tracker.track(image):
+                return True
             
-        except Exception as e:
-            logger.error(f"Failed to get source screenshot: {e}")
-            return None
-    
-    def detect_face(self, image):
-        """Detect faces in the image using MediaPipe"""
-        try:
-            rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            results = self.face_detection.process(rgb_image)
+            face_box = None
+            if self.tflite:
+                score, box = self.tflite.detect(image)
+                if score > self._conf_threshold:
+                    face_box = box
+            else:
+                results = self.face_detector.detect(mp.Image(image_format=mp.ImageFormat.SRGB, data=image))
+                # The detector already drops anything under min_detection_confidence
+                if results.detections:
+                    box = results.detections[0].bounding_box
+                    face_box = (box.origin_x, box.origin_y, box.width, box.height)
             
-            if results.detections:
-                for detection in results.detections:
-                    # Check if face is facing forward (confidence-based)
-                    if detection.score[0] > self.config.get('face_detection_confidence', 0.7):
-                        return True
-            return False
+            self.tracker.remember(image, face_box)
+            face_found = face_box is not None
+            self._last_small = small
+            self._last_result = face_found
+            self._static_reuse_count = 0
+            return face_found
         except Exception as e:
             logger.error(f"Face detection error: {e}")
             return False
@@ -154,36 +207,13 @@ class FaceDetectionDaemon:
                 logger.warning("Source name not configured")
                 return False
             
-            # Get all scenes
-            scenes_response = self.obs_ws.call(obs_requests.GetSceneList())
-            all_scenes = scenes_response.getScenes()
-            
-            changes_made = 0
-            
-            for scene in all_scenes:
-                scene_name = scene['sceneName']
-                
-                # Skip excluded scene
-                if exclude_scene and scene_name == exclude_scene:
-                    logger.debug(f"Skipping excluded scene: {scene_name}")
-                    continue
-                
-                # Get scene items
-                scene_items = self.obs_ws.call(obs_requests.GetSceneItemList(sceneName=scene_name))
-                
-                for item in scene_items.getSceneItems():
-                    if item['sourceName'] == source_name:
-                        self.obs_ws.call(obs_requests.SetSceneItemEnabled(
-                            sceneName=scene_name,
-                            sceneItemId=item['sceneItemId'],
-                            sceneItemEnabled=visible
-                        ))
-                        changes_made += 1
-                        logger.debug(f"Set {source_name} to {visible} in scene '{scene_name}'")
+            # Scene items come from the cache, and OBS confirms every toggle
+            with self._obs_lock:
+                changes_made = self.scene_items.set_enabled(source_name, visible, (exclude_scene,))
             
             if changes_made > 0:
                 action = "shown" if visible else "hidden"
-                logger.info(f"✓ {source_name} {action} in {changes_made} scene(s)")
+                logger.info(f"→ {source_name} {action} (in {changes_made} scene(s))")
                 return True
             else:
                 logger.debug(f"Source '{source_name}' not found in any scenes")
@@ -199,13 +229,14 @@ class FaceDetectionDaemon:
         standby_check_interval = self.config.get('standby_check_interval', 5)
         
         while True:
-            # Try to connect if not connected
-            if not self.obs_ws:
+            # Try to connect if not connected (drops a stale connection first)
+            if not self.is_obs_active():
                 if self.connect_obs():
                     logger.info("OBS connection established")
             
-            # Check if OBS is active
-            if self.obs_ws and self.is_obs_active():
+            # connect_obs() runs the connect callback before returning, so the
+            # flag is already current here; otherwise retry after the interval
+            if self._obs_connected.is_set():
                 logger.info("▶️  OBS is now active - Starting face detection")
                 return True
             
@@ -214,11 +245,15 @@ class FaceDetectionDaemon:
     def active_mode(self):
         """Active mode - monitor and switch sources"""
         logger.info("🔍 ACTIVE MODE - Face detection enabled")
+        self._init_detector()
         
         # Get configuration
         monitor_source = self.config.get('monitor_source_name')
         show_source = self.config.get('show_source_name')
         hide_source = self.config.get('hide_source_name')
+        # Exclusion scene (where monitoring source lives)
+        exclude_scene = self.config.get('detection_scene_name')
+        show_preview = self.config.get('show_preview', False)
         
         if not monitor_source:
             logger.error("monitor_source_name not configured")
@@ -233,7 +268,22 @@ class FaceDetectionDaemon:
         consecutive_errors = 0
         max_consecutive_errors = 5
         
+        frames = OBSFrameSource(self.config, self.obs_ws, self._obs_lock)
+        
+        # Screenshots arrive from a background thread through a one-frame slot
+        frame_slot = queue.Queue(maxsize=1)
+        stop_event = threading.Event()
+        screenshot_thread = threading.Thread(
+            target=frames.worker,
+            args=(monitor_source, frame_slot, stop_event),
+            daemon=True
+        )
+        
         try:
+            # Local capture is released in the finally block if anything here fails
+            frames.open_local_capture()
+            screenshot_thread.start()
+            
             while True:
                 # Check if OBS is still active
                 if not self.is_obs_active():
@@ -246,15 +296,17 @@ class FaceDetectionDaemon:
                     self.face_detected = False
                     return True
                 
-                # Get screenshot from OBS source
-                frame = self.get_source_screenshot(monitor_source)
+                # Wait for the newest screenshot (time out to re-check OBS state)
+                try:
+                    frame = frame_slot.get(timeout=1)
+                except queue.Empty:
+                    continue
                 
                 if frame is None:
                     consecutive_errors += 1
                     if consecutive_errors >= max_consecutive_errors:
                         logger.error("Too many consecutive errors, returning to standby")
                         return False
-                    time.sleep(self.config.get('check_interval', 0.5))
                     continue
                 
                 consecutive_errors = 0
@@ -267,9 +319,6 @@ class FaceDetectionDaemon:
                     self.face_detected = current_face_detected
                     self.last_detection_time = time.time()
                     
-                    # Get exclusion scene (where monitoring source lives)
-                    exclude_scene = self.config.get('detection_scene_name')
-                    
                     if self.face_detected:
                         logger.info("👤 Face detected!")
                         # Show source in ALL scenes (no exclusions when showing)
@@ -288,7 +337,9 @@ class FaceDetectionDaemon:
                             self.set_source_visibility_global(hide_source, True, exclude_scene=None)
                 
                 # Optional: Show preview window (for debugging)
-                if self.config.get('show_preview', False):
+                if show_preview:
+                    # Frames are RGB, convert once for display only (as a UMat)
+                    frame = self._preview.convert(frame)
                     status = "FACE DETECTED" if self.face_detected else "NO FACE"
                     color = (0, 255, 0) if self.face_detected else (0, 0, 255)
                     cv2.putText(frame, status, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 
@@ -297,14 +348,16 @@ class FaceDetectionDaemon:
                     if cv2.waitKey(1) & 0xFF == ord('q'):
                         break
                 
-                # Sleep to control check interval
-                time.sleep(self.config.get('check_interval', 0.5))
-                
         except Exception as e:
             logger.error(f"Runtime error in active mode: {e}")
             import traceback
             traceback.print_exc()
             return False
+        finally:
+            stop_event.set()
+            if screenshot_thread.is_alive():
+                screenshot_thread.join(timeout=2)
+            frames.close_local_capture()
     
     def run(self):
         """Main daemon loop"""
@@ -334,7 +387,9 @@ class FaceDetectionDaemon:
             import traceback
             traceback.print_exc()
         finally:
-            cv2.destroyAllWindows()
+            # cv2 is only loaded once active mode has run
+            if cv2 is not None:
+                cv2.destroyAllWindows()
             self.disconnect_obs()
             logger.info("Daemon stopped")
 
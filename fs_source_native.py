@@ -10,10 +10,14 @@ import time
 import cv2
 import mediapipe as mp
 import numpy as np
-from obswebsocket import obsws, requests as obs_requests
+from obswebsocket import obsws
 import logging
+import queue
+import signal
 import sys
+import threading
 from pathlib import Path
+from fs_common import SceneItemCache, create_tflite_detector, get_face_detector
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -24,15 +28,52 @@ class FaceDetectionNative:
         self.config = config
         self.obs_ws = None
         self.camera = None
-        self.mp_face_detection = mp.solutions.face_detection
-        self.mp_drawing = mp.solutions.drawing_utils
-        self.face_detection = self.mp_face_detection.FaceDetection(
-            model_selection=0, 
-            min_detection_confidence=config.get('face_detection_confidence', 0.7)
-        )
+        self._conf_threshold = config.get('face_detection_confidence', 0.7)
+        # Scores outside [stable_low, stable_high] count as a confident answer; while
+        # answers stay confident, up to max_skip_frames detections are skipped
+        self._stable_low = config.get('stable_low', 0.4)
+        self._stable_high = config.get('stable_high', 0.85)
+        self._max_skip_frames = config.get('max_skip_frames', 8)
+        self._stable_count = 0
+        self._skip_n = 0
+        self._last_result = False
+        # Grey 64x48 thumbnail of the last frame MediaPipe ran on, for the motion gate
+        self._prev_small = None
+        self._motion_threshold = config.get('motion_threshold', 3000)
+        # Marginal scores under the threshold are needed to tell "confidently no
+        # face" from "almost a face", so the detector's own cut-off sits lower
+        self.tflite = create_tflite_detector(config, bgr=True)
+        self.face_detection = None if self.tflite else \
+            get_face_detector(min(self._conf_threshold, self._stable_low))
         self.face_detected = False
         self.last_detection_time = 0
+        # BlazeFace works at 128x128, so frames are shrunk before conversion/inference
+        self._detect_scale = config.get('detect_scale', 0.5)
+        # Reused downscale/RGB buffers, (re)allocated when the frame size changes
+        self._small_buf = None
+        self._rgb_buf = None
+        # Created once connected to OBS
+        self.scene_items = None
+        # Visibility changes for the OBS writer thread: (source, visible, exclude_scene)
+        self._obs_queue = queue.Queue()
+        self._obs_thread = None
+        # Preview status labels, rasterised once: {face_detected: (patch, mask)}
+        self._preview_labels = self._make_preview_labels() if config.get('show_preview', False) else None
+        # Window updates cost a few ms each, so the preview is capped at preview_fps
+        self._preview_interval = 1 / config.get('preview_fps', 15)
+        self._last_preview_time = 0
         
+    def _make_preview_labels(self):
+        """Render the two preview status labels once, with masks for blitting"""
+        labels = {}
+        for detected, text, color in ((True, "FACE DETECTED", (0, 255, 0)),
+                                      (False, "NO FACE", (0, 0, 255))):
+            patch = np.zeros((42, 260, 3), dtype=np.uint8)
+            cv2.putText(patch, text, (10, 30), cv2.FONT_HERSHEY_SIMPLEX,
+                        1, color, 2, cv2.LINE_AA)
+            labels[detected] = (patch, patch.any(axis=2).astype(np.uint8))
+        return labels
+    
     def connect_obs(self):
         """Connect to OBS WebSocket"""
         try:
@@ -43,6 +84,13 @@ class FaceDetectionNative:
             )
             self.obs_ws.connect()
             logger.info(f"Connected to OBS at {self.config['obs_host']}:{self.config['obs_port']}")
+            
+            self.scene_items = SceneItemCache(self.obs_ws)
+            self.scene_items.build()
+            
+            # All OBS traffic after this point happens on the writer thread
+            self._obs_thread = threading.Thread(target=self._obs_writer, daemon=True)
+            self._obs_thread.start()
             return True
         except Exception as e:
             logger.error(f"Failed to connect to OBS: {e}")
@@ -50,6 +98,10 @@ class FaceDetectionNative:
     
     def disconnect_obs(self):
         """Disconnect from OBS WebSocket"""
+        if self._obs_thread:
+            self._obs_queue.put(None)
+            self._obs_thread.join(timeout=2)
+            self._obs_thread = None
         if self.obs_ws:
             self.obs_ws.disconnect()
             logger.info("Disconnected from OBS")
@@ -63,7 +115,12 @@ class FaceDetectionNative:
             # Try camera path first if specified
             if camera_path:
                 logger.info(f"Opening camera: {camera_path}")
-                self.camera = cv2.VideoCapture(camera_path)
+                # Linux device paths are V4L2; ask for it so CAP_PROP_BUFFERSIZE is
+                # honoured. Anything else (URLs, files, other OSes) picks its own backend
+                if sys.platform.startswith('linux') and camera_path.startswith('/dev/'):
+                    self.camera = cv2.VideoCapture(camera_path, cv2.CAP_V4L2)
+                else:
+                    self.camera = cv2.VideoCapture(camera_path)
             else:
                 logger.info(f"Opening camera index: {camera_index}")
                 self.camera = cv2.VideoCapture(camera_index)
@@ -72,6 +129,15 @@ class FaceDetectionNative:
                 logger.error(f"Failed to open camera")
                 return False
             
+            # Keep a single frame in the driver queue so detection sees fresh frames
+            self.camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+            
+            # Ask for MJPEG (must come before the size on V4L2): far less USB bandwidth
+            # than raw YUYV, and libjpeg-turbo decodes it cheaply
+            fourcc = self.config.get('camera_fourcc', 'MJPG')
+            if fourcc:
+                self.camera.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+            
             # Set camera properties for better performance
             width = self.config.get('camera_width', 640)
             height = self.config.get('camera_height', 480)
@@ -85,8 +151,10 @@ class FaceDetectionNative:
             actual_width = int(self.camera.get(cv2.CAP_PROP_FRAME_WIDTH))
             actual_height = int(self.camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
             actual_fps = int(self.camera.get(cv2.CAP_PROP_FPS))
+            # Some backends report -1 (or a sign-extended code), keep the low 32 bits
+            actual_fourcc = (int(self.camera.get(cv2.CAP_PROP_FOURCC)) & 0xFFFFFFFF).to_bytes(4, 'little').decode('ascii', 'replace')
             
-            logger.info(f"Camera initialized: {actual_width}x{actual_height} @ {actual_fps}fps")
+            logger.info(f"Camera initialized: {actual_width}x{actual_height} @ {actual_fps}fps ({actual_fourcc})")
             return True
             
         except Exception as e:
@@ -99,22 +167,105 @@ class FaceDetectionNative:
             self.camera.release()
             logger.info("Camera released")
     
+    def _capture_worker(self, frame_slot, stop_event):
+        """Read the camera on a background thread so capture never waits on detection/OBS"""
+        check_interval = self.config.get('check_interval', 0.1)
+        next_detect = time.monotonic()
+        
+        while not stop_event.is_set():
+            # grab() paces the thread to the camera's FPS without decoding;
+            # only frames we actually run detection on get retrieve()d
+            ret = self.camera.grab()
+            now = time.monotonic()
+            if ret and now < next_detect:
+                continue
+            frame = None
+            if ret:
+                # Fixed cadence: advance the deadline rather than restarting it from
+                # now, so it does not drift; if we fell behind, start over rather than burst
+                next_detect += check_interval
+                if next_detect < now:
+                    next_detect = now
+                ret, frame = self.camera.retrieve()
+            
+            # Latest frame wins - drop one detection has not picked up yet;
+            # None tells the detection loop the read failed
+            try:
+                frame_slot.get_nowait()
+            except queue.Empty:
+                pass
+            frame_slot.put_nowait(frame if ret else None)
+            
+            if not ret:
+                stop_event.wait(0.5)
+    
+    def _mediapipe_face_score(self, image):
+        """Best MediaPipe FaceDetection score for a BGR frame"""
+        if self._detect_scale < 1:
+            height, width = image.shape[:2]
+            small_shape = (int(height * self._detect_scale), int(width * self._detect_scale), 3)
+            if self._small_buf is None or self._small_buf.shape != small_shape:
+                self._small_buf = np.empty(small_shape, dtype=np.uint8)
+            cv2.resize(image, (small_shape[1], small_shape[0]), dst=self._small_buf,
+                       interpolation=cv2.INTER_AREA)
+            image = self._small_buf
+        
+        if self._rgb_buf is None or self._rgb_buf.shape != image.shape:
+            self._rgb_buf = np.empty_like(image)
+        cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=self._rgb_buf)
+        results = self.face_detection.process(self._rgb_buf)
+        
+        detections = results.detections or []
+        return max((detection.score[0] for detection in detections), default=0.0)
+    
     def detect_face(self, image):
         """Detect faces in the image using MediaPipe"""
         try:
-            rgb_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            results = self.face_detection.process(rgb_image)
+            # Nothing moved since the last detection: keep the previous answer
+            thumb = cv2.cvtColor(cv2.resize(image, (64, 48), interpolation=cv2.INTER_AREA),
+                                 cv2.COLOR_BGR2GRAY)
+            if self._prev_small is not None and \
+                    int(cv2.absdiff(thumb, self._prev_small).sum()) < self._motion_threshold:
+                return self._last_result
             
-            if results.detections:
-                for detection in results.detections:
-                    # Check if face is facing forward (confidence-based)
-                    if detection.score[0] > self.config.get('face_detection_confidence', 0.7):
-                        return True
-            return False
+            # Stable state: reuse the last answer instead of running MediaPipe
+            if self._skip_n > 0:
+                self._skip_n -= 1
+                return self._last_result
+            
+            if self.tflite:
+                score = self.tflite.best_score(image)
+            else:
+                score = self._mediapipe_face_score(image)
+            
+            # Back off gradually while the score stays well clear of the threshold,
+            # and go back to every frame as soon as it turns marginal
+            if score > self._stable_high or score < self._stable_low:
+                self._stable_count += 1
+                self._skip_n = min(self._max_skip_frames, self._stable_count // 3)
+            else:
+                self._stable_count = 0
+                self._skip_n = 0
+            
+            self._prev_small = thumb
+            self._last_result = score > self._conf_threshold
+            return self._last_result
         except Exception as e:
             logger.error(f"Face detection error: {e}")
             return False
     
+    def _obs_writer(self):
+        """Apply queued visibility changes so OBS round-trips never block detection"""
+        while True:
+            change = self._obs_queue.get()
+            if change is None:
+                break
+            self.set_source_visibility_global(*change)
+    
+    def queue_source_visibility(self, source_name, visible, exclude_scene=None):
+        """Hand a visibility change to the OBS writer thread"""
+        self._obs_queue.put((source_name, visible, exclude_scene))
+    
     def set_source_visibility_global(self, source_name, visible, exclude_scene=None):
         """Set OBS source visibility across all scenes, with optional scene exclusion"""
         if not self.obs_ws:
@@ -125,39 +276,15 @@ class FaceDetectionNative:
                 logger.warning("Source name not configured")
                 return False
             
-            # Get all scenes
-            scenes_response = self.obs_ws.call(obs_requests.GetSceneList())
-            all_scenes = scenes_response.getScenes()
-            
-            changes_made = 0
-            
-            for scene in all_scenes:
-                scene_name = scene['sceneName']
-                
-                # Skip excluded scene
-                if exclude_scene and scene_name == exclude_scene:
-                    logger.debug(f"Skipping excluded scene: {scene_name}")
-                    continue
-                
-                # Get scene items
-                scene_items = self.obs_ws.call(obs_requests.GetSceneItemList(sceneName=scene_name))
-                
-                for item in scene_items.getSceneItems():
-                    if item['sourceName'] == source_name:
-                        self.obs_ws.call(obs_requests.SetSceneItemEnabled(
-                            sceneName=scene_name,
-                            sceneItemId=item['sceneItemId'],
-                            sceneItemEnabled=visible
-                        ))
-                        changes_made += 1
-                        logger.debug(f"Set {source_name} to {visible} in scene '{scene_name}'")
+            # Scene items come from the cache, and OBS confirms every toggle
+            changes_made = self.scene_items.set_enabled(source_name, visible, (exclude_scene,))
             
             if changes_made > 0:
                 action = "shown" if visible else "hidden"
-                logger.info(f"✓ {source_name} {action} in {changes_made} scene(s)")
+                logger.info("→ %s %s (in %d scene(s))", source_name, action, changes_made)
                 return True
             else:
-                logger.debug(f"Source '{source_name}' not found in any scenes")
+                logger.debug("Source '%s' not found in any scenes", source_name)
                 return False
                 
         except Exception as e:
@@ -184,6 +311,8 @@ class FaceDetectionNative:
         # Get configuration
         show_source = self.config.get('show_source_name')
         hide_source = self.config.get('hide_source_name')
+        # Exclusion scene (kept showing show_source when the face goes)
+        exclude_scene = self.config.get('detection_scene_name')
         
         logger.info("Face detection active (using local camera)")
         if show_source:
@@ -195,20 +324,41 @@ class FaceDetectionNative:
         consecutive_errors = 0
         max_consecutive_errors = 10
         
+        # Frames arrive from a capture thread through a one-frame slot; detection
+        # and OBS calls stay on this thread
+        frame_slot = queue.Queue(maxsize=1)
+        stop_event = threading.Event()
+        capture_thread = threading.Thread(
+            target=self._capture_worker,
+            args=(frame_slot, stop_event),
+            daemon=True
+        )
+        capture_thread.start()
+        
+        # Ctrl+C ends the loop between frames rather than interrupting an OBS call,
+        # and needs no waitKey polling when the preview is off
+        def request_stop(signum, _frame):
+            logger.info("Shutting down...")
+            stop_event.set()
+        
+        previous_sigint = signal.signal(signal.SIGINT, request_stop)
+        
         try:
-            while True:
-                # Read frame from local camera
-                ret, frame = self.camera.read()
+            while not stop_event.is_set():
+                # Time out now and then so a stop request is seen even without frames
+                try:
+                    frame = frame_slot.get(timeout=1)
+                except queue.Empty:
+                    continue
                 
-                if not ret:
+                if frame is None:
                     consecutive_errors += 1
-                    logger.warning(f"Failed to read from camera (attempt {consecutive_errors}/{max_consecutive_errors})")
+                    logger.warning("Failed to read from camera (attempt %d/%d)", consecutive_errors, max_consecutive_errors)
                     
                     if consecutive_errors >= max_consecutive_errors:
                         logger.error("Too many consecutive camera errors")
                         break
                     
-                    time.sleep(0.5)
                     continue
                 
                 consecutive_errors = 0
@@ -219,41 +369,35 @@ class FaceDetectionNative:
                 # Toggle sources if face detection state changed
                 if current_face_detected != self.face_detected:
                     self.face_detected = current_face_detected
-                    self.last_detection_time = time.time()
-                    
-                    # Get exclusion scene
-                    exclude_scene = self.config.get('detection_scene_name')
+                    self.last_detection_time = time.monotonic()
                     
                     if self.face_detected:
                         logger.info("👤 Face detected!")
                         # Show source in ALL scenes (no exclusions when showing)
                         if show_source:
-                            self.set_source_visibility_global(show_source, True, exclude_scene=None)
+                            self.queue_source_visibility(show_source, True, exclude_scene=None)
                         # Hide other source in ALL scenes (no exclusions)
                         if hide_source:
-                            self.set_source_visibility_global(hide_source, False, exclude_scene=None)
+                            self.queue_source_visibility(hide_source, False, exclude_scene=None)
                     else:
                         logger.info("❌ Face gone")
                         # Hide source in ALL scenes EXCEPT the exclusion scene
                         if show_source:
-                            self.set_source_visibility_global(show_source, False, exclude_scene=exclude_scene)
+                            self.queue_source_visibility(show_source, False, exclude_scene=exclude_scene)
                         # Show other source in ALL scenes (no exclusions)
                         if hide_source:
-                            self.set_source_visibility_global(hide_source, True, exclude_scene=None)
+                            self.queue_source_visibility(hide_source, True, exclude_scene=None)
                 
                 # Optional: Show preview window (for debugging)
-                if self.config.get('show_preview', False):
-                    status = "FACE DETECTED" if self.face_detected else "NO FACE"
-                    color = (0, 255, 0) if self.face_detected else (0, 0, 255)
-                    cv2.putText(frame, status, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 
-                               1, color, 2, cv2.LINE_AA)
+                now = time.monotonic()
+                if self._preview_labels and now - self._last_preview_time >= self._preview_interval:
+                    self._last_preview_time = now
+                    label, mask = self._preview_labels[self.face_detected]
+                    cv2.copyTo(label, mask, frame[:label.shape[0], :label.shape[1]])
                     cv2.imshow('FS Source Native - Face Detection', frame)
                     if cv2.waitKey(1) & 0xFF == ord('q'):
                         break
                 
-                # Sleep to control check interval
-                time.sleep(self.config.get('check_interval', 0.1))
-                
         except KeyboardInterrupt:
             logger.info("Shutting down...")
         except Exception as e:
@@ -261,6 +405,9 @@ class FaceDetectionNative:
             import traceback
             traceback.print_exc()
         finally:
+            signal.signal(signal.SIGINT, previous_sigint)
+            stop_event.set()
+            capture_thread.join(timeout=2)
             cv2.destroyAllWindows()
             self.release_camera()
             self.disconnect_obs()
@@ -6,6 +6,7 @@ Test script to verify camera and face detection functionality
 import cv2
 import mediapipe as mp
 import sys
+from fs_common import FrameGrabber, get_face_detector
 
 def test_camera():
     """Test camera access"""
@@ -37,11 +38,7 @@ def test_face_detection():
     print("Testing MediaPipe face detection...")
     
     try:
-        mp_face_detection = mp.solutions.face_detection
-        face_detection = mp_face_detection.FaceDetection(
-            model_selection=0, 
-            min_detection_confidence=0.7
-        )
+        get_face_detector(0.7)
         print("✅ MediaPipe face detection initialized")
         return True
     except Exception as e:
@@ -63,23 +60,32 @@ def test_live_detection():
         print("❌ Cannot open camera for live test")
         return False
     
-    mp_face_detection = mp.solutions.face_detection
+    # Single-frame driver queue keeps the preview from lagging behind
+    camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    
     mp_drawing = mp.solutions.drawing_utils
-    face_detection = mp_face_detection.FaceDetection(
-        model_selection=0, 
-        min_detection_confidence=0.7
-    )
+    face_detection = get_face_detector(0.7)
     
     print("Live detection active. Press 'q' to quit.")
     
+    rgb_frame = None
+    # Capture runs on its own thread; this loop only detects and draws
+    grabber = FrameGrabber(camera)
+    
     try:
         while True:
-            ret, frame = camera.read()
-            if not ret:
-                break
+            frame = grabber.get()
+            if frame is None:
+                if grabber.failed:
+                    break
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+                continue
             
-            # Convert BGR to RGB
-            rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            # Convert BGR to RGB into a reused buffer
+            if rgb_frame is None or rgb_frame.shape != frame.shape:
+                rgb_frame = frame.copy()
+            cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=rgb_frame)
             results = face_detection.process(rgb_frame)
             
             # Draw face detections
@@ -96,6 +102,7 @@ def test_live_detection():
     except KeyboardInterrupt:
         print("\nTest interrupted by user")
     finally:
+        grabber.stop()
         camera.release()
         cv2.destroyAllWindows()
         print("✅ Live detection test completed")
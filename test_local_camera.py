@@ -6,88 +6,83 @@ Helps identify which camera index or path to use for native mode
 
 import cv2
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from fs_common import FrameGrabber
 
-def test_camera_index(index):
-    """Test a specific camera index"""
-    print(f"Testing camera index {index}...")
+def probe_camera(camera_ref):
+    """Open a camera index or device path and read one frame (no printing)
     
-    camera = cv2.VideoCapture(index)
-    
-    if not camera.isOpened():
-        print(f"  ❌ Cannot open camera {index}")
-        return False
-    
-    ret, frame = camera.read()
-    if not ret:
-        print(f"  ❌ Camera {index} opened but failed to read frame")
+    Returns (camera_ref, error, info) where info holds width/height/fps/shape
+    when the camera works and error says why it does not
+    """
+    camera = cv2.VideoCapture(camera_ref)
+    try:
+        if not camera.isOpened():
+            return camera_ref, f"Cannot open camera {camera_ref}", None
+        
+        ret, frame = camera.read()
+        if not ret:
+            return camera_ref, f"Camera {camera_ref} opened but failed to read frame", None
+        
+        return camera_ref, None, {
+            'width': int(camera.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            'fps': int(camera.get(cv2.CAP_PROP_FPS)),
+            'shape': frame.shape,
+        }
+    finally:
         camera.release()
-        return False
-    
-    width = int(camera.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = int(camera.get(cv2.CAP_PROP_FPS))
-    
-    print(f"  ✅ Camera {index} works!")
-    print(f"     Resolution: {width}x{height}")
-    print(f"     FPS: {fps}")
-    print(f"     Frame shape: {frame.shape}")
-    
-    camera.release()
-    return True
 
-def test_camera_path(path):
-    """Test a specific camera device path"""
-    print(f"Testing camera path: {path}...")
-    
-    camera = cv2.VideoCapture(path)
-    
-    if not camera.isOpened():
-        print(f"  ❌ Cannot open camera {path}")
-        return False
-    
-    ret, frame = camera.read()
-    if not ret:
-        print(f"  ❌ Camera {path} opened but failed to read frame")
-        camera.release()
-        return False
-    
-    width = int(camera.get(cv2.CAP_PROP_FRAME_WIDTH))
-    height = int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = int(camera.get(cv2.CAP_PROP_FPS))
+def print_probe(camera_ref, error, info):
+    """Print the result of probe_camera"""
+    kind = "index" if isinstance(camera_ref, int) else "path:"
+    print(f"Testing camera {kind} {camera_ref}...")
     
-    print(f"  ✅ Camera {path} works!")
-    print(f"     Resolution: {width}x{height}")
-    print(f"     FPS: {fps}")
-    print(f"     Frame shape: {frame.shape}")
-    
-    camera.release()
-    return True
+    if error:
+        print(f"  ❌ {error}")
+    else:
+        print(f"  ✅ Camera {camera_ref} works!")
+        print(f"     Resolution: {info['width']}x{info['height']}")
+        print(f"     FPS: {info['fps']}")
+        print(f"     Frame shape: {info['shape']}")
+    print()
+    return error is None
 
 def live_preview(camera_ref):
     """Show live preview from camera"""
     print(f"\nStarting live preview from {camera_ref}...")
     print("Press 'q' to quit")
     
-    camera = cv2.VideoCapture(camera_ref)
+    if isinstance(camera_ref, str) and sys.platform.startswith('linux') and camera_ref.startswith('/dev/'):
+        camera = cv2.VideoCapture(camera_ref, cv2.CAP_V4L2)
+    else:
+        camera = cv2.VideoCapture(camera_ref)
     
     if not camera.isOpened():
         print("❌ Cannot open camera for preview")
         return
     
+    # Single-frame driver queue keeps the preview from lagging behind
+    camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    
+    # Capture runs on its own thread so USB reads never block the window
+    grabber = FrameGrabber(camera)
+    
     try:
         while True:
-            ret, frame = camera.read()
-            if not ret:
+            frame = grabber.get()
+            if frame is not None:
+                cv2.imshow('Camera Preview - Press Q to quit', frame)
+            elif grabber.failed:
                 print("Failed to read frame")
                 break
             
-            cv2.imshow('Camera Preview - Press Q to quit', frame)
-            
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 break
     except KeyboardInterrupt:
         print("\nPreview stopped")
     finally:
+        grabber.stop()
         camera.release()
         cv2.destroyAllWindows()
 
@@ -96,27 +91,31 @@ def main():
     print("="*50)
     print()
     
-    # Test common camera indices
+    # Common camera indices, plus video device paths (Linux)
+    import os
+    indices = list(range(10))
+    video_devices = [f'/dev/video{i}' for i in range(20, 30) if os.path.exists(f'/dev/video{i}')]
+    
+    # Missing devices take up to a second each to time out, so probe them all at
+    # once; each probe owns its own VideoCapture handle
+    print("Probing cameras...")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(probe_camera, indices + video_devices))
+    print()
+    
     print("Testing camera indices...")
     print("-" * 50)
     working_cameras = []
     
-    for i in range(10):
-        if test_camera_index(i):
-            working_cameras.append(i)
-        print()
+    for result in results[:len(indices)]:
+        if print_probe(*result):
+            working_cameras.append(result[0])
     
-    # Test video device paths (Linux)
     print("Testing video device paths...")
     print("-" * 50)
-    import os
-    if os.path.exists('/dev'):
-        video_devices = [f'/dev/video{i}' for i in range(20, 30)]
-        for device in video_devices:
-            if os.path.exists(device):
-                if test_camera_path(device):
-                    working_cameras.append(device)
-                print()
+    for result in results[len(indices):]:
+        if print_probe(*result):
+            working_cameras.append(result[0])
     
     # Summary
     print("="*50)
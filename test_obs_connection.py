@@ -5,19 +5,111 @@ Test OBS WebSocket connection and list available sources
 
 import json
 import sys
+import threading
+import time
 from pathlib import Path
-from obswebsocket import obsws, requests as obs_requests
+
+# orjson is a drop-in, much faster JSON parser that works on the raw UTF-8 bytes;
+# ujson is the C fallback where the orjson wheel isn't available
+try:
+    from orjson import loads as json_loads, dumps as json_dumps
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        _json = json
+
+    def json_loads(data):
+        return _json.loads(data.decode('utf-8'))
+
+    def json_dumps(obj):
+        return _json.dumps(obj).encode('utf-8')
+
+# The websocket clients are imported by load_obs_modules() once the config has
+# loaded, so the missing-config path exits without paying for them
+asyncio = obsws = obs_requests = simpleobsws = None
+
+CONFIG_PATH = Path('config/obs_config.json')
+# Scene/source discovery from the last run, reused for CACHE_MAX_AGE seconds
+# unless the config changed since (skip with --no-cache)
+CACHE_PATH = Path('config/.obs_discovery_cache.json')
+CACHE_MAX_AGE = 300
+
+# Seconds between GetStats pings that keep an idle connection open
+KEEPALIVE_INTERVAL = 15
+
+def load_obs_modules():
+    """Import the OBS websocket clients into module globals; False if unavailable"""
+    global asyncio, obsws, obs_requests, simpleobsws
+    if obs_requests is not None:
+        return True
+    try:
+        from obswebsocket import obsws, requests as obs_requests
+    except ImportError:
+        print("❌ obs-websocket-py is not installed")
+        print("Install it with: pip install obs-websocket-py")
+        return False
+    # Optional asyncio client; when installed, requests run concurrently under asyncio.gather
+    try:
+        import asyncio
+        import simpleobsws
+    except ImportError:
+        simpleobsws = None
+    return True
 
 def load_config():
     """Load configuration"""
-    config_path = Path('config/obs_config.json')
+    config_path = CONFIG_PATH
     if not config_path.exists():
         print(f"❌ Configuration file not found: {config_path}")
         print("Run setup.py first to create configuration")
         return None
     
-    with open(config_path, 'r') as f:
-        return json.load(f)
+    with open(config_path, 'rb') as f:
+        return json_loads(f.read())
+
+class AsyncOBSClient:
+    """simpleobsws behind the obsws call()/disconnect() interface
+    
+    Coroutines run on a private event loop, so the rest of the script stays
+    synchronous; call_batch() overlaps its requests with asyncio.gather.
+    """
+    
+    def __init__(self, config):
+        self.loop = asyncio.new_event_loop()
+        self.client = simpleobsws.WebSocketClient(
+            url=f"ws://{config['obs_host']}:{config['obs_port']}",
+            password=config.get('obs_password', '')
+        )
+        self.loop.run_until_complete(self._connect())
+    
+    async def _connect(self):
+        await self.client.connect()
+        if not await self.client.wait_until_identified():
+            await self.client.disconnect()
+            raise ConnectionError("OBS did not identify the client (check the password)")
+    
+    async def _call(self, request):
+        """Run an obswebsocket request object over simpleobsws and fill in its response"""
+        response = await self.client.call(simpleobsws.Request(request.name, request.data() or None))
+        # Failed requests carry no responseData; keep their status comment
+        if response.ok():
+            request.input(response.responseData or {}, True)
+        else:
+            request.input({'comment': response.requestStatus.comment}, False)
+        return request
+    
+    def call(self, request):
+        return self.loop.run_until_complete(self._call(request))
+    
+    def call_batch(self, batch):
+        async def gather():
+            return await asyncio.gather(*(self._call(request) for request in batch))
+        return self.loop.run_until_complete(gather())
+    
+    def disconnect(self):
+        self.loop.run_until_complete(self.client.disconnect())
+        self.loop.close()
 
 def test_connection(config):
     """Test OBS WebSocket connection"""
@@ -25,20 +117,23 @@ def test_connection(config):
     print(f"Host: {config['obs_host']}")
     print(f"Port: {config['obs_port']}")
     
+    if not load_obs_modules():
+        return None
+    
     try:
-        ws = obsws(
-            config['obs_host'], 
-            config['obs_port'], 
-            config.get('obs_password', '')
-        )
-        ws.connect()
+        if simpleobsws:
+            ws = AsyncOBSClient(config)
+        else:
+            ws = obsws(
+                config['obs_host'], 
+                config['obs_port'], 
+                config.get('obs_password', '')
+            )
+            ws.connect()
+            # Set after connecting so a failed first connect still reports
+            # instead of retrying; later drops reconnect every second
+            ws.authreconnect = 1
         print("✅ Successfully connected to OBS!")
-        
-        # Get OBS version
-        version = ws.call(obs_requests.GetVersion())
-        print(f"OBS Version: {version.getObsVersion()}")
-        print(f"WebSocket Version: {version.getObsWebSocketVersion()}")
-        
         return ws
     except Exception as e:
         print(f"❌ Failed to connect to OBS: {e}")
@@ -48,50 +143,147 @@ def test_connection(config):
         print("3. Check host/port/password in config/obs_config.json")
         return None
 
-def list_scenes(ws):
-    """List all scenes"""
-    print("\n" + "="*50)
-    print("Available Scenes:")
-    print("="*50)
+def call_batch(ws, batch):
+    """Send several requests back to back, then collect all the answers
+    
+    obs-websocket-py cannot read RequestBatch responses, so the requests are
+    pipelined instead: the whole list costs one round-trip rather than one each.
+    Returns the request objects populated with their responses, like ws.call().
+    """
+    if isinstance(ws, AsyncOBSClient):
+        return ws.call_batch(batch)
     
+    pending = []
+    for request in batch:
+        message_id = str(ws.id)
+        ws.id += 1
+        ws.events[message_id] = threading.Event()
+        ws.ws.send(json.dumps({
+            "op": 6,
+            "d": {
+                "requestId": message_id,
+                "requestType": request.name,
+                "requestData": request.data()
+            }
+        }))
+        pending.append((request, message_id))
+    
+    for request, message_id in pending:
+        ws.events[message_id].wait(ws.timeout)
+        ws.events.pop(message_id)
+        answer = ws.answers.pop(message_id, None)
+        if answer is None:
+            raise TimeoutError(f"No answer for {request.name}")
+        # Failed requests carry no responseData; keep their status (code, comment)
+        request.input(answer.get('responseData', answer['requestStatus']), answer['requestStatus']['result'])
+    
+    return [request for request, _ in pending]
+
+def discover(ws, scene_name=None):
+    """Query OBS versions, scenes and one scene's sources as plain data
+    
+    scene_name defaults to the current program scene. The requests share a
+    round-trip; a configured scene can go in the first one, otherwise its items
+    need the current scene from the scene list.
+    """
+    batch = [obs_requests.GetVersion(), obs_requests.GetSceneList()]
+    if scene_name:
+        batch.append(obs_requests.GetSceneItemList(sceneName=scene_name))
+    version, scenes, *scene_items = call_batch(ws, batch)
+    
+    for response in (version, scenes):
+        if not response.status:
+            raise RuntimeError(f"{response.name} failed: {response.datain.get('comment')}")
+    
+    current_scene = scenes.getCurrentProgramSceneName()
+    if not scene_name:
+        scene_name = current_scene
+        scene_items = call_batch(ws, [obs_requests.GetSceneItemList(sceneName=scene_name)])
+    scene_items = scene_items[0]
+    
+    return {
+        'obs_version': version.getObsVersion(),
+        'ws_version': version.getObsWebSocketVersion(),
+        'scenes': [scene['sceneName'] for scene in scenes.getScenes()],
+        'current_scene': current_scene,
+        'scene_name': scene_name,
+        'items': scene_items.getSceneItems() if scene_items.status else None,
+        'items_error': None if scene_items.status else scene_items.datain.get('comment'),
+    }
+
+def load_discovery_cache():
+    """Return cached discovery data if it is recent and newer than the config"""
     try:
-        scenes = ws.call(obs_requests.GetSceneList())
-        current_scene = scenes.getCurrentProgramSceneName()
-        
-        for scene in scenes.getScenes():
-            scene_name = scene['sceneName']
-            marker = " ← CURRENT" if scene_name == current_scene else ""
-            print(f"  • {scene_name}{marker}")
-        
-        return current_scene
-    except Exception as e:
-        print(f"❌ Failed to list scenes: {e}")
+        cache_mtime = CACHE_PATH.stat().st_mtime
+        if time.time() - cache_mtime > CACHE_MAX_AGE or cache_mtime < CONFIG_PATH.stat().st_mtime:
+            return None
+        with open(CACHE_PATH, 'rb') as f:
+            return json_loads(f.read())
+    except (OSError, ValueError):
         return None
 
-def list_sources_in_scene(ws, scene_name):
-    """List all sources in a scene"""
+def save_discovery_cache(discovery):
+    """Store discovery data for the next run (only complete results)"""
+    if discovery['items'] is None:
+        return
+    try:
+        with open(CACHE_PATH, 'wb') as f:
+            f.write(json_dumps(discovery))
+    except OSError as e:
+        print(f"(Could not write discovery cache: {e})")
+
+def print_discovery(discovery):
+    """Print versions, scenes and sources in one pass"""
+    print(f"OBS Version: {discovery['obs_version']}")
+    print(f"WebSocket Version: {discovery['ws_version']}")
+    
+    print("\n" + "="*50)
+    print("Available Scenes:")
+    print("="*50)
+    for scene_name in discovery['scenes']:
+        marker = " ← CURRENT" if scene_name == discovery['current_scene'] else ""
+        print(f"  • {scene_name}{marker}")
+    
     print(f"\n" + "="*50)
-    print(f"Sources in Scene: {scene_name}")
+    print(f"Sources in Scene: {discovery['scene_name']}")
     print("="*50)
     
-    try:
-        scene_items = ws.call(obs_requests.GetSceneItemList(sceneName=scene_name))
-        
-        if not scene_items.getSceneItems():
-            print("  (No sources in this scene)")
-            return
-        
-        for item in scene_items.getSceneItems():
-            source_name = item['sourceName']
-            source_type = item.get('sourceType', 'unknown')
-            enabled = item.get('sceneItemEnabled', True)
-            status = "✓ Visible" if enabled else "✗ Hidden"
-            print(f"  • {source_name}")
-            print(f"    Type: {source_type} | Status: {status}")
-            print(f"    ID: {item['sceneItemId']}")
-        
-    except Exception as e:
-        print(f"❌ Failed to list sources: {e}")
+    if discovery['items'] is None:
+        print(f"❌ Failed to list sources: {discovery['items_error']}")
+        return
+    
+    items = discovery['items']
+    if not items:
+        print("  (No sources in this scene)")
+        return
+    
+    # One write for the whole listing instead of three prints per item
+    lines = [
+        f"  • {item['sourceName']}\n"
+        f"    Type: {item.get('sourceType', 'unknown')} | "
+        f"Status: {'✓ Visible' if item.get('sceneItemEnabled', True) else '✗ Hidden'}\n"
+        f"    ID: {item['sceneItemId']}"
+        for item in items
+    ]
+    sys.stdout.write('\n'.join(lines) + '\n')
+
+def start_keepalive(ws, lock):
+    """Ping OBS with GetStats while the connection sits idle; returns a stop event
+    
+    Requests on a connection are not thread-safe, so every caller holds lock.
+    """
+    stop = threading.Event()
+    
+    def ping():
+        while not stop.wait(KEEPALIVE_INTERVAL):
+            try:
+                with lock:
+                    ws.call(obs_requests.GetStats())
+            except Exception as e:
+                print(f"(Keep-alive ping failed: {e})")
+    
+    threading.Thread(target=ping, daemon=True).start()
+    return stop
 
 def test_screenshot(ws, source_name):
     """Test getting a screenshot from a source"""
@@ -107,14 +299,21 @@ def test_screenshot(ws, source_name):
             imageHeight=240
         ))
         
-        img_data = response.getImageData()
-        img_size = len(img_data) if img_data else 0
+        # The payload is a base64 data URL; the PNG size follows from the
+        # encoded length, so there's no need to decode it just to report it
+        b64_data = (response.getImageData() or '').partition(',')[2]
+        img_size = (len(b64_data) * 3) // 4 - b64_data.count('=', -2)
         print(f"✅ Successfully captured screenshot")
-        print(f"   Data size: {img_size:,} bytes")
+        print(f"   PNG size: {img_size:,} bytes")
         
     except Exception as e:
         print(f"❌ Failed to capture screenshot: {e}")
 
+def test_screenshots(ws, source_names):
+    """Test screenshots from several sources over the same connection"""
+    for source_name in source_names:
+        test_screenshot(ws, source_name)
+
 def main():
     print("FS Source - OBS Connection Test")
     print("="*50)
@@ -129,13 +328,27 @@ def main():
     if not ws:
         sys.exit(1)
     
-    # List scenes
-    current_scene = list_scenes(ws)
+    # Keep the socket alive while waiting on prompts
+    ws_lock = threading.Lock()
+    stop_keepalive = start_keepalive(ws, ws_lock)
     
-    # List sources in configured scene
-    scene_name = config.get('scene_name', current_scene)
-    if scene_name:
-        list_sources_in_scene(ws, scene_name)
+    # Scenes and sources rarely change between runs, so a fresh cache stands in
+    # for the discovery requests
+    discovery = None if '--no-cache' in sys.argv[1:] else load_discovery_cache()
+    if discovery:
+        print(f"(Scenes and sources cached {time.time() - discovery['ts']:.0f}s ago, --no-cache to refresh)")
+    else:
+        try:
+            with ws_lock:
+                discovery = discover(ws, config.get('scene_name'))
+        except Exception as e:
+            print(f"❌ Failed to query OBS: {e}")
+            ws.disconnect()
+            sys.exit(1)
+        discovery['ts'] = time.time()
+        save_discovery_cache(discovery)
+    
+    print_discovery(discovery)
     
     # Test screenshot if monitor source is configured
     monitor_source = config.get('monitor_source_name')
@@ -143,10 +356,13 @@ def main():
         print(f"\nConfigured monitor source: {monitor_source}")
         response = input(f"Test screenshot capture from '{monitor_source}'? (y/n): ").lower()
         if response in ['y', 'yes']:
-            test_screenshot(ws, monitor_source)
+            with ws_lock:
+                test_screenshots(ws, [monitor_source])
     
     # Disconnect
-    ws.disconnect()
+    stop_keepalive.set()
+    with ws_lock:
+        ws.disconnect()
     print("\n✅ All tests completed!")
     print("\nIf you see your configured sources above, you're ready to run ./fs_source.py")
 